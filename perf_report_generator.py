@@ -1,7 +1,19 @@
+import csv
+import os
 import pickle
+import queue
+import tempfile
+import threading
+import urllib.parse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from dataclasses import dataclass
-from typing import Tuple
+from math import fsum
+from typing import Iterator
 
+import msgpack
+import requests
 from selenium import webdriver
 from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.chrome.options import Options
@@ -12,15 +24,47 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 
 BENCH_TABLE_CLASS = 'bench-table'
+COMPARE_DATA_URL = 'https://perf.rust-lang.org/perf/get'
+CACHE_DIR = '.cache'
 
+# Ids of the compare page bench tables for each compile benchmark category, results fetched from the API
+# are put into tables with the same names so they aggregate together with results scraped from the page
+CATEGORY_TABLE_IDS = {
+    'primary': 'primary-benchmarks',
+    'secondary': 'secondary-benchmarks',
+}
 
-@dataclass
+# Thousands separators and the % and x suffixes of the numbers shown in the compare page tables
+NUMBER_DECORATIONS = str.maketrans('', '', ',%x')
+
+CHROME_ARGUMENTS = [
+    '--headless=new',
+    '--disable-gpu',
+    '--disable-dev-shm-usage',
+    '--no-sandbox',
+    '--disable-extensions',
+    '--disable-background-networking',
+    '--disable-default-apps',
+    '--disable-sync',
+    '--blink-settings=imagesEnabled=false',
+    '--disable-features=Translate,BackForwardCache',
+]
+
+# Stylesheets are not blocked, cell texts are read as rendered and depend on them
+BLOCKED_URL_PATTERNS = ['*.png', '*.jpg', '*.gif', '*.svg', '*.ico', '*.woff', '*.woff2']
+
+
+def parse_number(s: str) -> float:
+    return float(s.translate(NUMBER_DECORATIONS))
+
+
+@dataclass(slots=True)
 class BenchTable:
     name: str
     results: list['BenchmarkResult']
 
 
-@dataclass
+@dataclass(slots=True)
 class BenchmarkResult:
     name: str
     profile: str
@@ -41,50 +85,185 @@ class BenchmarkResult:
             scenario=raw_row[3],
             backend=raw_row[4],
             target=raw_row[5],
-            change=BenchmarkResult.parse_number(raw_row[6][:-1]),
-            sig_threshold=BenchmarkResult.parse_number(raw_row[7][:-1]),
-            sig_factor=BenchmarkResult.parse_number(raw_row[8][:-1]),
-            before_raw=BenchmarkResult.parse_number(raw_row[9]),
-            after_raw=BenchmarkResult.parse_number(raw_row[10]),
+            change=parse_number(raw_row[6]),
+            sig_threshold=parse_number(raw_row[7]),
+            sig_factor=parse_number(raw_row[8]),
+            before_raw=parse_number(raw_row[9]),
+            after_raw=parse_number(raw_row[10]),
         )
 
     @staticmethod
-    def parse_number(s: str) -> float:
-        return float(s.replace(',', ''))
+    def parse_from_json(comparison: dict) -> 'BenchmarkResult':
+        stats = comparison['comparison']
+        before_raw, after_raw = stats['statistics']
+        return BenchmarkResult(
+            name=comparison['benchmark'],
+            profile=comparison['profile'],
+            scenario=comparison['scenario'],
+            backend=comparison['backend'],
+            target=comparison['target'],
+            change=(after_raw - before_raw) / before_raw * 100,
+            sig_threshold=stats['significance_threshold'] * 100,
+            sig_factor=stats['significance_factor'] or 0.0,
+            before_raw=before_raw,
+            after_raw=after_raw,
+        )
+
+
+class BrowserPool:
+    """Hands out idle browsers to the download workers, launching a new one only when none is idle."""
+
+    def __init__(self):
+        self.idle_browsers: queue.SimpleQueue[WebDriver] = queue.SimpleQueue()
+        self.exit_stack = ExitStack()
+        self.lock = threading.Lock()
+
+    def __enter__(self) -> 'BrowserPool':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.exit_stack.close()
+
+    @contextmanager
+    def acquire(self) -> Iterator[WebDriver]:
+        try:
+            browser = self.idle_browsers.get_nowait()
+        except queue.Empty:
+            browser_context = chrome_browser()
+            browser = browser_context.__enter__()
+            with self.lock:
+                self.exit_stack.push(browser_context)
+
+        try:
+            yield browser
+        finally:
+            self.idle_browsers.put(browser)
+
+
+@contextmanager
+def chrome_browser() -> Iterator[WebDriver]:
+    chrome_options = Options()
+    for argument in CHROME_ARGUMENTS:
+        chrome_options.add_argument(argument)
+    # The tables are waited for explicitly, there is no need to wait for the full page load
+    chrome_options.page_load_strategy = 'eager'
+    browser = webdriver.Chrome(options=chrome_options)
+
+    try:
+        browser.execute_cdp_cmd('Network.enable', {})
+        browser.execute_cdp_cmd('Network.setBlockedURLs', {'urls': BLOCKED_URL_PATTERNS})
+
+        yield browser
+    finally:
+        browser.quit()
+
+
+def download_benchmarks_data(
+        browser_pool: BrowserPool,
+        first_sha: str,
+        second_sha: str,
+        stat: str,
+        tab: str
+) -> list[BenchTable]:
+    cache_file_path = os.path.join(CACHE_DIR, f'{first_sha}_{second_sha}_{stat.replace(":", "-")}_{tab}.pkl')
+
+    if os.path.exists(cache_file_path):
+        try:
+            with open(cache_file_path, 'rb') as fin:
+                tables = pickle.load(fin)
+            print(f'Using cached data from {cache_file_path}')
+            return tables
+        except Exception as e:
+            # E.g. entries pickled before the data classes got slots, they are downloaded again and overwritten
+            print(f'Cached data in {cache_file_path} cannot be loaded ({e!r}), downloading it again')
+
+    tables = fetch_benchmarks_data(browser_pool, first_sha, second_sha, stat, tab)
+
+    # The compare page shows an alert for any failed data fetch, not only for invalid commits,
+    # so an empty result may be transient and is downloaded again next time
+    if len(tables) == 0:
+        return tables
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Written under a unique temporary name first so that an interrupted run does not leave a truncated
+    # cache entry, and workers downloading the same pair concurrently do not write into the same file
+    with tempfile.NamedTemporaryFile(dir=CACHE_DIR, suffix='.tmp', delete=False) as fout:
+        pickle.dump(tables, fout, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(fout.name, cache_file_path)
+
+    return tables
+
 
+def fetch_benchmarks_data(
+        browser_pool: BrowserPool,
+        first_sha: str,
+        second_sha: str,
+        stat: str,
+        tab: str
+) -> list[BenchTable]:
+    if tab == 'compile':
+        try:
+            return download_compile_comparisons(first_sha, second_sha, stat)
+        except Exception as e:
+            print(f'Failed to fetch comparison data from the API ({e!r}), falling back to the compare page')
 
-def download_benchmarks_data(first_sha: str, second_sha: str, stat: str, tab: str) -> list[BenchTable]:
     url = construct_query_url(first_sha, second_sha, stat, tab)
-    browser, alert_shown = download_url(url)
 
-    if alert_shown:
-        print(f'An alert was triggered, commits {first_sha} and {second_sha} are invalid for comparison')
-        return []
+    with browser_pool.acquire() as browser:
+        alert_shown = download_url(browser, url)
+
+        if alert_shown:
+            browser.switch_to.alert.dismiss()
+            print(f'An alert was triggered, commits {first_sha} and {second_sha} are invalid for comparison')
+            return []
+
+        return parse_benchmark_tables(browser)
+
 
-    return parse_benchmark_tables(browser)
+def download_compile_comparisons(first_sha: str, second_sha: str, stat: str) -> list[BenchTable]:
+    print(f'Started fetching comparison data for {first_sha}, {second_sha}')
+    # This is the same request the compare page makes, the response is encoded with msgpack
+    response = requests.post(
+        COMPARE_DATA_URL,
+        json={'start': first_sha, 'end': second_sha, 'stat': stat},
+        timeout=60
+    )
+    response.raise_for_status()
+    data = msgpack.unpackb(response.content)
 
+    # An unknown benchmark or category raises here, which makes the caller fall back to the compare page
+    table_ids = {m['name']: CATEGORY_TABLE_IDS[m['category'].lower()] for m in data['compile_benchmark_metadata']}
+    bench_tables: dict[str, BenchTable] = {}
 
-def construct_query_url(first_sha: str, second_sha: str, stat: str, tab: str):
-    base_url = 'https://perf.rust-lang.org/compare.html?'
+    for comparison in data['compile_comparisons']:
+        # Relative change is undefined for a zero baseline
+        if comparison['comparison']['statistics'][0] == 0:
+            continue
 
-    def add_query_param(base_url: str, key: str, value: str) -> str:
-        return base_url + f'{key}={value}&'
+        table_name = table_ids[comparison['benchmark']]
+        if table_name not in bench_tables:
+            bench_tables[table_name] = BenchTable(name=table_name, results=[])
 
-    base_url = add_query_param(base_url, 'start', first_sha)
-    base_url = add_query_param(base_url, 'end', second_sha)
-    base_url = add_query_param(base_url, 'stat', stat)
-    base_url = add_query_param(base_url, 'tab', tab)
-    base_url = add_query_param(base_url, 'nonRelevant', 'true')
-    base_url = add_query_param(base_url, 'showRawData', 'true')
+        bench_tables[table_name].results.append(BenchmarkResult.parse_from_json(comparison))
 
-    return base_url
+    print('Finished fetching comparison data')
 
+    return list(bench_tables.values())
 
-def download_url(url: str) -> Tuple[WebDriver, bool]:
+
+def construct_query_url(first_sha: str, second_sha: str, stat: str, tab: str) -> str:
+    return 'https://perf.rust-lang.org/compare.html?' + urllib.parse.urlencode({
+        'start': first_sha,
+        'end': second_sha,
+        'stat': stat,
+        'tab': tab,
+        'nonRelevant': 'true',
+        'showRawData': 'true',
+    }, safe=':')
+
+
+def download_url(browser: WebDriver, url: str) -> bool:
     print(f"Started downloading URL {url}")
-    chrome_options = Options()
-    chrome_options.add_argument("--headless=new")
-    browser = webdriver.Chrome(options=chrome_options)
     browser.get(url)
 
     bench_tables_ec = EC.presence_of_element_located((By.CLASS_NAME, BENCH_TABLE_CLASS))
@@ -98,26 +277,28 @@ def download_url(url: str) -> Tuple[WebDriver, bool]:
 
     print('Finished downloading page')
 
-    return browser, type(element) is Alert
+    return type(element) is Alert
+
+
+# Collects the text of all cells of all bench tables in a single WebDriver round-trip
+READ_BENCH_TABLES_SCRIPT = f"""
+return Array.from(document.getElementById('app').getElementsByClassName('{BENCH_TABLE_CLASS}')).map(table => {{
+    const body = table.querySelector('tbody');
+    const rows = body === null ? null : Array.from(body.querySelectorAll('tr')).map(
+        row => Array.from(row.querySelectorAll('td')).map(cell => cell.innerText.trim())
+    );
+    return [table.id, rows];
+}});
+"""
 
 
 def parse_benchmark_tables(browser: WebDriver) -> list[BenchTable]:
-    elem = browser.find_element(value='app')
-    tables = elem.find_elements(By.CLASS_NAME, BENCH_TABLE_CLASS)
+    tables = browser.execute_script(READ_BENCH_TABLES_SCRIPT)
 
     bench_tables = []
-    for table in tables:
-        table_id = table.get_attribute('id')
+    for table_id, rows in tables:
         try:
-            table_body = table.find_element(By.TAG_NAME, 'tbody')
-            rows = table_body.find_elements(By.TAG_NAME, 'tr')
-
-            bench_results = []
-
-            for row in rows:
-                cols = row.find_elements(By.TAG_NAME, 'td')
-                raw_row = list(map(lambda c: c.text, cols))
-                bench_results.append(BenchmarkResult.parse_from_row(raw_row))
+            bench_results = list(map(BenchmarkResult.parse_from_row, rows))
 
             bench_tables.append(BenchTable(
                 name=table_id,
@@ -129,58 +310,65 @@ def parse_benchmark_tables(browser: WebDriver) -> list[BenchTable]:
     return bench_tables
 
 
-def read_commits_file(file_path: str) -> list[(str, str)]:
+def read_commits_file(file_path: str) -> list[tuple[str, str]]:
+    commits = []
+
     with open(file_path, 'r') as fin:
-        return list(map(lambda s: s.split(), fin.readlines()))
+        for line_number, line in enumerate(fin, start=1):
+            shas = line.split()
+            if len(shas) == 0:
+                continue
+
+            if len(shas) != 2:
+                raise ValueError(f'{file_path}:{line_number}: expected two commit SHAs, got {len(shas)}')
+
+            commits.append((shas[0], shas[1]))
+
+    return commits
+
+
+# Aggregated values in the order of the output CSV columns, together with the column names
+ORDERED_KEYS = ('change', 'raw_change')
+KEY_COLUMN_NAMES = {'change': 'SumChange', 'raw_change': 'SumRawChange'}
 
 
 class AggregatedBenchData:
+    __slots__ = ('name', 'values', 'ordered_values')
+
     def __init__(self, name: str, raw_values: dict[str, list[float]]):
         assert len(raw_values) > 0
 
         self.name = name
-        self.values = dict(map(lambda p: (p[0], sum(p[1])), raw_values.items()))
-
-        self.ordered_values = list(self.values.items())
-        self.ordered_values.sort(key=lambda x: x[0])
+        self.values = {key: fsum(values) for key, values in raw_values.items()}
 
-    def to_csv_line(self) -> str:
-        return f'{self.name};{";".join(map(lambda x: str(x[1]), self.ordered_values))}\n'
+        self.ordered_values = [(key, self.values[key]) for key in ORDERED_KEYS]
 
     def __repr__(self) -> str:
         return f'{self.name} = ({self.values})'
 
 
 def serialize_results_to_csv(results: list[AggregatedBenchData], output_file_path: str):
-    with open(output_file_path, 'w') as fout:
-        fout.writelines([
-            'Benchmark;SumChange;SumRawChange\n',
-            *list(map(lambda r: r.to_csv_line(), results))
-        ])
+    with open(output_file_path, 'w', newline='') as fout:
+        writer = csv.writer(fout, delimiter=';', lineterminator='\n')
+        writer.writerow(['Benchmark', *map(lambda k: KEY_COLUMN_NAMES[k], ORDERED_KEYS)])
+
+        for result in results:
+            writer.writerow([result.name, *map(lambda x: x[1], result.ordered_values)])
 
 
 def aggregate_tables_data(tables: list[BenchTable], output_file_path: str):
     print('Started serializing results')
 
-    benches_results: dict[str, dict[str, list[float]]] = {}
+    benches_results: defaultdict[str, defaultdict[str, list[float]]] = defaultdict(lambda: defaultdict(list))
 
     for table in tables:
         for res in table.results:
-            bench_full_name = '::'.join([table.name, res.name, res.profile, res.scenario])
-
-            def get_or_create(d, key, default):
-                if key not in d:
-                    d[key] = default
+            bench_results = benches_results[f'{table.name}::{res.name}::{res.profile}::{res.scenario}']
+            bench_results['change'].append(res.change)
+            bench_results['raw_change'].append(res.after_raw - res.before_raw)
 
-                return d[key]
-
-            bench_results = get_or_create(benches_results, bench_full_name, {})
-            get_or_create(bench_results, 'change', []).append(res.change)
-            get_or_create(bench_results, 'raw_change', []).append(res.after_raw - res.before_raw)
-
-    filtered_results = filter(lambda x: len(x[1]) > 0, benches_results.items())
-    mapped_results = map(lambda x: AggregatedBenchData(x[0], x[1]), filtered_results)
-    aggregated_results: list[AggregatedBenchData] = list(mapped_results)
+    # Every entry holds at least one value, entries are only created when a result is appended
+    aggregated_results = [AggregatedBenchData(name, values) for name, values in benches_results.items()]
     aggregated_results.sort(key=lambda a: a.values['change'])
 
     serialize_results_to_csv(aggregated_results, output_file_path)
@@ -188,30 +376,37 @@ def aggregate_tables_data(tables: list[BenchTable], output_file_path: str):
     print(f'Serialized results to the output file {output_file_path}')
 
 
-def download_tables(commits_file_path: str) -> list[BenchTable]:
+def download_tables(commits_file_path: str, parallel: int = 1) -> list[BenchTable]:
     commits = read_commits_file(commits_file_path)
     tables = []
 
-    for [from_commit, to_commit] in commits:
+    def download_commits_pair(from_commit: str, to_commit: str) -> list[BenchTable]:
         print(f'Downloading commits data: {from_commit}, {to_commit}')
 
-        tables.extend(download_benchmarks_data(
+        pair_tables = download_benchmarks_data(
+            browser_pool,
             from_commit,
             to_commit,
             'instructions:u',
             'compile'
-        ))
+        )
 
         print('Downloaded commits data')
 
+        return pair_tables
+
+    with BrowserPool() as browser_pool, ThreadPoolExecutor(max_workers=parallel) as executor:
+        for pair_tables in executor.map(lambda c: download_commits_pair(*c), commits):
+            tables.extend(pair_tables)
+
     return tables
 
 
-def execute_download_command(commits_file_path: str, output_file_path: str):
-    tables = download_tables(commits_file_path)
+def execute_download_command(commits_file_path: str, output_file_path: str, parallel: int):
+    tables = download_tables(commits_file_path, parallel)
 
     with open(output_file_path, 'wb') as fout:
-        pickle.dump(tables, fout)
+        pickle.dump(tables, fout, protocol=pickle.HIGHEST_PROTOCOL)
 
 
 def execute_aggregate_command(tables_file_path: str, output_file_path: str):
@@ -224,17 +419,25 @@ def execute_aggregate_command(tables_file_path: str, output_file_path: str):
 def main():
     import sys
 
-    command = sys.argv[1]
+    args = sys.argv[1:]
+    parallel = 1
+
+    if '--parallel' in args:
+        index = args.index('--parallel')
+        parallel = int(args[index + 1])
+        del args[index:index + 2]
+
+    command = args[0]
 
     if command == 'download':
-        commits_file_path, output_file_path = sys.argv[2], sys.argv[3]
-        execute_download_command(commits_file_path, output_file_path)
+        commits_file_path, output_file_path = args[1], args[2]
+        execute_download_command(commits_file_path, output_file_path, parallel)
     elif command == 'aggregate':
-        tables_file_path, output_file_path = sys.argv[2], sys.argv[3]
+        tables_file_path, output_file_path = args[1], args[2]
         execute_aggregate_command(tables_file_path, output_file_path)
     else:
-        commits_file_path, output_file_path = sys.argv[1], sys.argv[2]
-        tables = download_tables(commits_file_path)
+        commits_file_path, output_file_path = args[0], args[1]
+        tables = download_tables(commits_file_path, parallel)
         aggregate_tables_data(tables, output_file_path)
 
 